@@ -3,9 +3,28 @@
 
 from __future__ import unicode_literals
 
+import base64
+import pickle
+import threading
+
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import close_old_connections, connections
+from django.db.models import Max, Min, Q
+from django.db.models.query import QuerySet
+from django.forms.models import BaseInlineFormSet
+from django.utils.functional import cached_property
+
+from .models import Log, PushNotification, PushRecipient, PushStatistic, get_token_hash
+from .push import requeue_range
+from .settings import get_recipient_index
+
+
+# Below this many rows an exact COUNT(*) is cheap enough
+ESTIMATED_COUNT_THRESHOLD = 100000
 
-from .models import Log, PushNotification, STATUS
+# Search terms at least this long without whitespace are treated as tokens
+TOKEN_MIN_LENGTH = 64
 
 
 def get_message_preview(instance):
@@ -16,28 +35,133 @@ def get_message_preview(instance):
 get_message_preview.short_description = 'Message'
 
 
+def bulk_insert_returns_ids(connection):
+    features = connection.features
+    # Renamed in Django 3.0
+    return getattr(features, 'can_return_rows_from_bulk_insert',
+                   getattr(features, 'can_return_ids_from_bulk_insert', False))
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Uses the PostgreSQL planner estimate (pg_class.reltuples) instead of
+    COUNT(*) for unfiltered changelists of large tables.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if isinstance(queryset, QuerySet) and not queryset.query.where:
+            connection = connections[queryset.db]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                                   [queryset.model._meta.db_table])
+                    row = cursor.fetchone()
+                if row and row[0] >= ESTIMATED_COUNT_THRESHOLD:
+                    return int(row[0])
+
+        return super(EstimatedCountPaginator, self).count
+
+
+class LogInlineFormSet(BaseInlineFormSet):
+    max_logs = 20
+
+    def get_queryset(self):
+        # Only the latest logs are shown, the full history is in LogAdmin
+        if not hasattr(self, '_capped_queryset'):
+            self._capped_queryset = super(LogInlineFormSet, self).get_queryset()[:self.max_logs]
+        return self._capped_queryset
+
+
 class LogInline(admin.StackedInline):
     model = Log
+    formset = LogInlineFormSet
+    ordering = ('-date',)
+    readonly_fields = ('date', 'status', 'exception_type', 'message')
+    can_delete = False
     extra = 0
+    max_num = 0
+
+
+def _requeue_in_background(queryset, min_id, max_id):
+    try:
+        requeue_range(queryset, min_id, max_id)
+    finally:
+        close_old_connections()
 
 
 def requeue(modeladmin, request, queryset):
-    """An admin action to requeue notifications."""
-    queryset.update(status=STATUS.queued)
+    """
+    An admin action to requeue notifications. Only the id range of the
+    selection is read in the request, the rows are updated range by range
+    by a Celery task if Celery is available or by a background thread
+    otherwise.
+    """
+    try:
+        from .tasks import requeue_push_notification_range
+    except ImportError:
+        requeue_push_notification_range = None
+
+    bounds = queryset.order_by().aggregate(min_id=Min('id'), max_id=Max('id'))
+    if bounds['min_id'] is None:
+        modeladmin.message_user(request, 'No notifications were requeued.')
+        return
+
+    if requeue_push_notification_range is not None:
+        # The selection is passed as a pickled query, so that the task
+        # applies the same filters as the admin changelist
+        query = base64.b64encode(pickle.dumps(queryset.query)).decode('ascii')
+        try:
+            requeue_push_notification_range.delay(query, bounds['min_id'], bounds['max_id'])
+        except Exception:
+            # The broker is unreachable, requeue from this process
+            pass
+        else:
+            modeladmin.message_user(request, 'Selected notifications will be requeued by a Celery worker.')
+            return
+
+    thread = threading.Thread(target=_requeue_in_background,
+                              args=(queryset, bounds['min_id'], bounds['max_id']))
+    thread.daemon = True
+    thread.start()
+    modeladmin.message_user(request, 'Selected notifications will be requeued in the background.')
+
+
+requeue.short_description = 'Requeue selected notifications'
 
 
 class NotificationAdmin(admin.ModelAdmin):
     list_display = ('id', 'title_display', 'template',
                     'status', 'last_updated')
-    search_fields = ['to', 'title']
-    date_hierarchy = 'last_updated'
+    search_fields = ['title']
     inlines = [LogInline]
-    list_filter = ['status', 'template__language', 'template__name']
+    list_filter = ['status', 'last_updated', 'template__language', 'template__name']
     actions = [requeue]
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     def get_queryset(self, request):
         return super(NotificationAdmin, self).get_queryset(request).select_related('template')
 
+    def get_search_results(self, request, queryset, search_term):
+        # With RECIPIENT_INDEX tokens are looked up by their indexed hash
+        # instead of LIKE on `to`
+        term = search_term.strip()
+        if len(term) >= TOKEN_MIN_LENGTH and len(term.split()) == 1:
+            if not get_recipient_index():
+                return queryset.filter(to__contains=term), False
+
+            recipients = PushRecipient.objects.filter(token_hash=get_token_hash(term))
+            lookup = Q(id__in=recipients.values('notification_id'))
+            # Without primary keys from bulk_create() send_many() can't
+            # store token hashes, such rows are only found by `to`
+            if not bulk_insert_returns_ids(connections[queryset.db]):
+                lookup |= Q(to__contains=term)
+            return queryset.filter(lookup), False
+
+        return super(NotificationAdmin, self).get_search_results(request, queryset, search_term)
+
     def title_display(self, instance):
         if instance.template and instance.template.subject:
             return instance.template.subject
@@ -52,7 +176,23 @@ class NotificationAdmin(admin.ModelAdmin):
 
 class LogAdmin(admin.ModelAdmin):
     list_display = ('date', 'notification', 'status', get_message_preview)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+class StatisticAdmin(admin.ModelAdmin):
+    list_display = ('hour', 'template', 'status', 'count')
+    list_filter = ['status', 'template__language', 'template__name']
+    date_hierarchy = 'hour'
+    readonly_fields = ('hour', 'template', 'status', 'count')
+
+    def get_queryset(self, request):
+        return super(StatisticAdmin, self).get_queryset(request).select_related('template')
+
+    def has_add_permission(self, request):
+        return False
 
 
 admin.site.register(PushNotification, NotificationAdmin)
 admin.site.register(Log, LogAdmin)
+admin.site.register(PushStatistic, StatisticAdmin)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import threading
+import time
+
+from six.moves import queue
+
+from django.db import close_old_connections
+
+from .logutils import setup_loghandlers
+from .models import PushNotification, STATUS
+from .settings import get_background_flush_timeout, get_background_queue_size, get_background_threads
+
+
+logger = setup_loghandlers("INFO")
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+class BackgroundDispatcher(object):
+    """
+    Sends priority = 'now' notifications off the caller's thread. Notifications
+    are put on a bounded in-process queue drained by a small pool of daemon
+    threads. When the queue is full, or the process exits before it is
+    drained, notifications are put back to the database queue instead.
+    """
+
+    def __init__(self, queue_size=None, threads=None, flush_timeout=None):
+        self.queue = queue.Queue(queue_size if queue_size is not None else get_background_queue_size())
+        self.threads = threads if threads is not None else get_background_threads()
+        self.flush_timeout = flush_timeout if flush_timeout is not None else get_background_flush_timeout()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._workers:
+                return
+
+            for i in range(self.threads):
+                worker = threading.Thread(target=self._run, name='fcm-async-dispatcher-%d' % i)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+            atexit.register(self.shutdown)
+
+    def submit(self, notification, log_level=None):
+        """
+        Queues notification for sending, returns False if the queue is full
+        and the notification was handed over to the database queue.
+        """
+        self.start()
+        try:
+            self.queue.put_nowait((notification, log_level))
+        except queue.Full:
+            logger.warning('Dispatcher queue is full, notification #%d is queued instead' %
+                           notification.id)
+            self._requeue([notification])
+            return False
+        return True
+
+    def shutdown(self, timeout=None):
+        """
+        Waits up to timeout seconds for queued notifications to be sent and
+        puts the rest back to the database queue.
+        """
+        with self._lock:
+            workers, self._workers = self._workers, []
+
+        if not workers:
+            return
+
+        if timeout is None:
+            timeout = self.flush_timeout
+        deadline = time.time() + timeout
+
+        try:
+            for _ in workers:
+                self.queue.put(None, timeout=max(deadline - time.time(), 0))
+        except queue.Full:
+            pass
+
+        for worker in workers:
+            worker.join(max(deadline - time.time(), 0))
+
+        pending = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                pending.append(item[0])
+
+        if pending:
+            logger.warning('Dispatcher stopped with %s unsent notifications, queueing them' %
+                           len(pending))
+            self._requeue(pending)
+
+    def _requeue(self, notifications):
+        # Only notifications that are still waiting for dispatch are queued,
+        # the status of the ones a worker already sent is left as is
+        notification_ids = [notification.id for notification in notifications]
+        PushNotification.objects.filter(id__in=notification_ids, status=None) \
+            .update(status=STATUS.queued)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            notification, log_level = item
+            try:
+                notification.dispatch(log_level=log_level)
+            except Exception as e:
+                logger.error('Failed to dispatch notification #%d: %s' % (notification.id, e))
+            finally:
+                close_old_connections()
+
+
+def get_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = BackgroundDispatcher()
+    return _dispatcher
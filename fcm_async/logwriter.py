@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import random
+import threading
+
+from django.db import close_old_connections, transaction
+
+from .logutils import setup_loghandlers
+from .models import Log
+from .settings import (get_log_success_sample_rate, get_log_writer, get_log_writer_batch_size,
+                       get_log_writer_flush_interval)
+
+
+logger = setup_loghandlers("INFO")
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+class BackgroundLogWriter(object):
+    """
+    Buffers Log rows and inserts them with bulk_create from a daemon thread,
+    every flush_interval seconds or as soon as batch_size rows are buffered.
+    The buffer is flushed on exit.
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None):
+        self.batch_size = batch_size if batch_size is not None else get_log_writer_batch_size()
+        self.flush_interval = flush_interval if flush_interval is not None else get_log_writer_flush_interval()
+        self._buffer = []
+        self._lock = threading.Lock()
+        # Held across taking the buffer and inserting it, so that a final
+        # flush waits for an insert already running in the writer thread
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._thread = threading.Thread(target=self._run, name='fcm-async-log-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+            atexit.register(self.flush)
+
+    def write(self, logs):
+        self.start()
+        with self._lock:
+            self._buffer.extend(logs)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                logs, self._buffer = self._buffer, []
+
+            if logs:
+                try:
+                    Log.objects.bulk_create(logs, batch_size=self.batch_size)
+                except Exception as e:
+                    logger.error('Failed to write %s logs: %s' % (len(logs), e))
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+
+def get_background_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BackgroundLogWriter()
+    return _writer
+
+
+def sample_successes(notifications):
+    """
+    Returns the part of successfully sent notifications that should be
+    logged according to LOG_SUCCESS_SAMPLE_RATE.
+    """
+    rate = get_log_success_sample_rate()
+    if rate >= 1:
+        return notifications
+    return [notification for notification in notifications if random.random() < rate]
+
+
+def write_logs(logs):
+    """
+    Saves logs with the configured LOG_WRITER: 'sync' inserts them right
+    away, 'background' hands them to the BackgroundLogWriter once the
+    current transaction commits.
+    """
+    if not logs:
+        return
+
+    if get_log_writer() == 'background':
+        writer = get_background_writer()
+        transaction.on_commit(lambda: writer.write(logs))
+    else:
+        Log.objects.bulk_create(logs)
+
+
+def flush_logs():
+    """
+    Writes out logs buffered by the background writer, if it is running.
+    """
+    if _writer is not None:
+        _writer.flush()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...models import PushNotification, PushRecipient
+from ...settings import get_batch_size, get_recipient_index
+
+
+class Command(BaseCommand):
+    help = 'Store recipient token hashes of notifications that have none, used after enabling RECIPIENT_INDEX.'
+
+    def handle(self, verbosity, **options):
+        if not get_recipient_index():
+            raise CommandError('RECIPIENT_INDEX is not enabled.')
+
+        batch_size = get_batch_size()
+        queryset = PushNotification.objects.only('id', 'to').order_by('id')
+
+        count = 0
+        last_id = 0
+        while True:
+            notifications = list(queryset.filter(id__gt=last_id)[:batch_size])
+            if not notifications:
+                break
+
+            last_id = notifications[-1].id
+            indexed_ids = set(PushRecipient.objects.filter(notification__in=notifications)
+                              .values_list('notification_id', flat=True))
+            notifications = [notification for notification in notifications
+                             if notification.id not in indexed_ids]
+
+            with transaction.atomic():
+                PushRecipient.create_for(notifications)
+            count += len(notifications)
+
+        self.stdout.write("Indexed recipients of {0} notifications".format(count))
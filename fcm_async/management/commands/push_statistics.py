@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from django.utils.timezone import now
+
+from ...models import PushStatistic, STATUS
+
+
+class Command(BaseCommand):
+    help = 'Show hourly notification statistics per template.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-H', '--hours',
+                            type=int, default=24,
+                            help="Show statistics for this many last hours, defaults to 24.")
+        parser.add_argument('-t', '--template',
+                            help="Only show statistics for templates with this name.")
+        parser.add_argument('-c', '--compact',
+                            action='store_true', default=False,
+                            help="Recount queued notifications of the last --hours hours instead of "
+                                 "showing statistics, meant to be run periodically, e.g. from cron.")
+
+    def handle(self, verbosity, hours, template, compact, **options):
+        if compact:
+            PushStatistic.compact_queued(hours)
+            return
+
+        cutoff_date = now().replace(minute=0, second=0, microsecond=0) - datetime.timedelta(hours=hours)
+        statistics = PushStatistic.objects.filter(hour__gt=cutoff_date)
+        if template:
+            statistics = statistics.filter(template__name=template)
+
+        rows = {}
+        for row in statistics.values('hour', 'template_key', 'template__name', 'template__language', 'status') \
+                .annotate(total=Sum('count')):
+            if row['template__name']:
+                name = row['template__name']
+            elif row['template_key']:
+                name = u'#{0} (deleted)'.format(row['template_key'])
+            else:
+                name = '-'
+            key = (row['hour'], name, row['template__language'] or '')
+            rows.setdefault(key, {}).update({row['status']: row['total']})
+
+        line = u'{0:<20} {1:<40} {2:>10} {3:>10} {4:>10}'
+        self.stdout.write(line.format('Hour', 'Template', 'Sent', 'Failed', 'Queued'))
+        for (hour, name, language), counts in sorted(rows.items()):
+            if language:
+                name = u'{0} ({1})'.format(name, language)
+            self.stdout.write(line.format(hour.strftime('%Y-%m-%d %H:%M'), name,
+                                          counts.get(STATUS.sent, 0),
+                                          counts.get(STATUS.failed, 0),
+                                          counts.get(STATUS.queued, 0)))
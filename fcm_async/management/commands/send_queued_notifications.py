@@ -3,17 +3,18 @@
 
 import tempfile
 import sys
+import time
 
 from post_office.lockfile import FileLock, FileLocked
 
 from django.core.management.base import BaseCommand
-from django.db import connection
-from django.db.models import Q
+from django.db import close_old_connections, connection
 from django.utils.timezone import now
 
-from ...push import send_queued
-from ...models import PushNotification, STATUS
+from ...push import has_queued, send_queued
 from ...logutils import setup_loghandlers
+from ...scheduler import ScheduledSender
+from ...settings import get_poll_interval, get_scheduler_refill_interval, get_sweep_interval
 
 
 logger = setup_loghandlers()
@@ -38,27 +39,84 @@ class Command(BaseCommand):
             type=int,
             help='"0" to log nothing, "1" to only log errors',
         )
+        parser.add_argument(
+            '-d', '--daemon',
+            action='store_true',
+            default=False,
+            help='Keep running, sending scheduled notifications as soon as they are due',
+        )
 
     def handle(self, *args, **options):
         logger.info('Acquiring lock for sending queued notifications at %s.lock' %
                     options['lockfile'])
         try:
             with FileLock(options['lockfile']):
-
-                while 1:
-                    try:
-                        send_queued(options['processes'],
-                                    options.get('log_level'))
-                    except Exception as e:
-                        logger.error(e, exc_info=sys.exc_info(),
-                                     extra={'status_code': 500})
-                        raise
-
-                    # Close DB connection to avoid multiprocessing errors
-                    connection.close()
-
-                    if not PushNotification.objects.filter(status=STATUS.queued) \
-                            .filter(Q(scheduled_time__lte=now()) | Q(scheduled_time=None)).exists():
-                        break
+                if options['daemon']:
+                    self.run_daemon(options['processes'], options.get('log_level'))
+                else:
+                    self.send_all_queued(options['processes'], options.get('log_level'))
         except FileLocked:
             logger.info('Failed to acquire lock, terminating now.')
+
+    def send_all_queued(self, processes, log_level, scheduled=True):
+        while 1:
+            try:
+                result = send_queued(processes, log_level, scheduled)
+            except Exception as e:
+                logger.error(e, exc_info=sys.exc_info(),
+                             extra={'status_code': 500})
+                raise
+
+            # Nothing can be sent without an available transport
+            if result is None:
+                break
+
+            # Close DB connection to avoid multiprocessing errors
+            connection.close()
+
+            if not has_queued(scheduled):
+                break
+
+    def run_daemon(self, processes, log_level):
+        """
+        Sends scheduled notifications from a ScheduledSender refilled every
+        SCHEDULER_REFILL_INTERVAL seconds. Notifications without a
+        scheduled_time are polled every POLL_INTERVAL seconds, the full queue
+        is only swept every SWEEP_INTERVAL seconds for overdue notifications
+        the scheduler missed.
+        """
+        scheduler = ScheduledSender(log_level=log_level)
+        refill_interval = get_scheduler_refill_interval()
+        poll_interval = get_poll_interval()
+        sweep_interval = get_sweep_interval()
+        next_refill = next_poll = next_sweep = time.time()
+
+        while 1:
+            try:
+                if time.time() >= next_refill:
+                    scheduler.refill()
+                    next_refill = time.time() + refill_interval
+
+                scheduler.send_due()
+
+                if time.time() >= next_sweep:
+                    self.send_all_queued(processes, log_level)
+                    next_sweep = time.time() + sweep_interval
+                    next_poll = time.time() + poll_interval
+                elif time.time() >= next_poll:
+                    self.send_all_queued(processes, log_level, scheduled=False)
+                    next_poll = time.time() + poll_interval
+            except Exception as e:
+                # Keep the long-running sender alive through transient
+                # errors, e.g. a lost database connection
+                logger.error(e, exc_info=sys.exc_info(),
+                             extra={'status_code': 500})
+                close_old_connections()
+                time.sleep(poll_interval)
+                continue
+
+            wake_up = min(next_refill, next_poll, next_sweep)
+            next_due = scheduler.next_due()
+            if next_due is not None:
+                wake_up = min(wake_up, time.time() + (next_due - now()).total_seconds())
+            time.sleep(max(wake_up - time.time(), 0))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+
+from django.db import migrations, models, transaction
+import django.db.models.deletion
+
+from fcm_async.settings import get_recipient_index
+
+
+BATCH_SIZE = 1000
+
+
+def fill_recipients(apps, schema_editor):
+    # Token hashes are only kept with RECIPIENT_INDEX enabled, otherwise the
+    # table is left empty (see the index_push_recipients command)
+    if not get_recipient_index():
+        return
+
+    PushNotification = apps.get_model('fcm_async', 'PushNotification')
+    PushRecipient = apps.get_model('fcm_async', 'PushRecipient')
+    db_alias = schema_editor.connection.alias
+    queryset = PushNotification.objects.using(db_alias).order_by('id')
+
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).values_list('id', 'to')[:BATCH_SIZE])
+        if not rows:
+            break
+
+        recipients = []
+        for notification_id, to in rows:
+            for token in set(to.splitlines()):
+                if token:
+                    recipients.append(PushRecipient(
+                        notification_id=notification_id,
+                        token_hash=hashlib.sha256(token.encode('utf-8')).hexdigest()))
+
+        with transaction.atomic(using=db_alias):
+            PushRecipient.objects.using(db_alias).bulk_create(recipients, batch_size=BATCH_SIZE)
+
+        last_id = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    # The backfill commits in batches so that large tables are not
+    # copied in a single transaction
+    atomic = False
+
+    dependencies = [
+        ('fcm_async', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushRecipient',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token_hash', models.CharField(db_index=True, max_length=64, verbose_name='Token hash')),
+                ('notification', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='fcm_async.PushNotification', verbose_name='Push notification')),
+            ],
+            options={
+                'verbose_name': 'Recipient',
+                'verbose_name_plural': 'Recipients',
+            },
+        ),
+        migrations.RunPython(fill_recipients, migrations.RunPython.noop),
+    ]
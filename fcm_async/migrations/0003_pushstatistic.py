@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('post_office', '0007_auto_20170731_1342'),
+        ('fcm_async', '0002_pushrecipient'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushStatistic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField(db_index=True, verbose_name='Hour')),
+                ('template_key', models.PositiveIntegerField(default=0, editable=False)),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'sent'), (1, 'failed'), (2, 'queued')], verbose_name='Status')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Count')),
+                ('template', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='post_office.EmailTemplate', verbose_name='Template')),
+            ],
+            options={
+                'verbose_name': 'Statistic',
+                'verbose_name_plural': 'Statistics',
+                'unique_together': {('hour', 'template_key', 'status')},
+            },
+        ),
+    ]
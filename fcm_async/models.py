@@ -1,25 +1,31 @@
 # -*- coding: utf-8 -*-
 # based on https://github.com/ui/django-post_office/blob/master/post_office/models.py
 
+import datetime
+import hashlib
+import json
 import re
-from collections import namedtuple
+from collections import Counter, namedtuple
 
 try:
     from post_office.compat import smart_text
 except ImportError:
     from django.utils.encoding import smart_str as smart_text
 
-import datetime
 import firebase_admin
-from firebase_admin import credentials, messaging
+from firebase_admin import credentials
 from six import python_2_unicode_compatible
 
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from django.template.backends.django import DjangoTemplates
 from django.template import Context
 
-from .settings import context_field_class, get_log_level, get_template_engine, get_firebase_key_path
+from .settings import (context_field_class, get_log_level, get_template_engine, get_firebase_key_path,
+                       get_recipient_index, get_statistics_enabled)
+from .transports import get_transport
 
 
 PRIORITY = namedtuple('PRIORITY', 'low medium high now')._make(range(4))
@@ -32,6 +38,14 @@ FIREBASE_APP = firebase_admin.initialize_app(FIREBASE_CREDENTIALS) if FIREBASE_C
 NON_ANCHOR_TAGS_RE = re.compile(r'(<[^aA/].*?>|</[^aA].*?>)')
 
 
+def get_token_hash(token):
+    """
+    Returns the hash stored in PushRecipient.token_hash, used for exact
+    token lookups without scanning the ``to`` column.
+    """
+    return hashlib.sha256(smart_text(token).encode('utf-8')).hexdigest()
+
+
 @python_2_unicode_compatible
 class PushNotification(models.Model):
     """
@@ -51,6 +65,7 @@ class PushNotification(models.Model):
     created = models.DateTimeField(auto_now_add=True, db_index=True)
     last_updated = models.DateTimeField(db_index=True, auto_now=True)
     scheduled_time = models.DateTimeField(_('The scheduled sending time'), blank=True, null=True, db_index=True)
+    claimed_at = models.DateTimeField(_('Claimed at'), blank=True, null=True, editable=False)
     template = models.ForeignKey('post_office.EmailTemplate', blank=True, null=True,
                                  verbose_name=_('Template'), on_delete=models.CASCADE)
     context = context_field_class(_('Context'), blank=True, null=True)
@@ -81,6 +96,18 @@ class PushNotification(models.Model):
 
         return self.prepare_notification_message()
 
+    def get_context(self):
+        """
+        Returns the template context. Notifications fetched by
+        ``push.get_queued()`` carry the context as raw JSON text, which is
+        decoded here on first use so rows rendered without a template never
+        pay for it.
+        """
+        if 'context' in self.get_deferred_fields() and hasattr(self, 'context_raw'):
+            raw = self.context_raw
+            self.context = json.loads(raw) if raw else None
+        return self.context
+
     def render_and_clean(self, engine, template_code, context_dict):
         context = Context(context_dict, autoescape=False)
         template = engine.from_string(template_code)
@@ -93,13 +120,14 @@ class PushNotification(models.Model):
         """
         if self.template is not None:
             engine = get_template_engine()
+            context = self.get_context()
             if isinstance(engine, DjangoTemplates):
-                title = self.render_and_clean(engine, self.template.subject, self.context)
+                title = self.render_and_clean(engine, self.template.subject, context)
                 content = self.template.html_content if self.template.html_content else self.template.content
-                text = self.render_and_clean(engine, content, self.context)
+                text = self.render_and_clean(engine, content, context)
             else:
-                title = engine.from_string(self.template.subject).render(self.context)
-                text = engine.from_string(self.template.content).render(self.context)
+                title = engine.from_string(self.template.subject).render(context)
+                text = engine.from_string(self.template.content).render(context)
         else:
             title = smart_text(self.title)
             text = self.text
@@ -110,27 +138,15 @@ class PushNotification(models.Model):
         return msg
 
     def send_firebase(self, msg):
-        firebase_message = messaging.MulticastMessage(
-            tokens=self.to.splitlines(),
-            apns=messaging.APNSConfig(
-                headers={'apns-priority': '5', 'apns-push-type': 'background'},
-                payload=messaging.APNSPayload(
-                    aps=messaging.Aps(content_available=True),
-                ),
-            ),
-            android=messaging.AndroidConfig(
-                ttl=datetime.timedelta(seconds=3600),
-                priority='normal',
-            ),
-            data={'title': msg['title'], 'body': msg['text']}
-        )
-        messaging.send_each_for_multicast(firebase_message)
-
-    def dispatch(self, log_level=None, commit=True):
+        get_transport().send(self, msg)
+
+    def dispatch(self, log_level=None, commit=True, record_statistics=True):
         """
-        Sends email and log the result.
+        Sends email and log the result. record_statistics=False leaves
+        PushStatistic alone, for dispatching in the caller's request where
+        the shared hourly counter would be contended.
         """
-        if not FIREBASE_APP:
+        if not get_transport().available:
             return STATUS.failed
         try:
             self.send_firebase(self.notification_message())
@@ -150,19 +166,26 @@ class PushNotification(models.Model):
         if commit:
             self.status = status
             self.save(update_fields=['status'])
+            if record_statistics:
+                PushStatistic.record([self], status)
 
             if log_level is None:
                 log_level = get_log_level()
 
+            from .logwriter import sample_successes, write_logs
+
             # If log level is 0, log nothing, 1 logs only sending failures
             # and 2 means log both successes and failures
             if log_level == 1:
-                if status == STATUS.failed:
-                    self.logs.create(status=status, message=message,
-                                     exception_type=exception_type)
+                should_log = status == STATUS.failed
             elif log_level == 2:
-                self.logs.create(status=status, message=message,
-                                 exception_type=exception_type)
+                should_log = status == STATUS.failed or bool(sample_successes([self]))
+            else:
+                should_log = False
+
+            if should_log:
+                write_logs([Log(notification=self, status=status, message=message,
+                                exception_type=exception_type)])
 
         return status
 
@@ -171,6 +194,47 @@ class PushNotification(models.Model):
         return super(PushNotification, self).save(*args, **kwargs)
 
 
+@python_2_unicode_compatible
+class PushRecipient(models.Model):
+    """
+    Hash of a single recipient token of a notification, so that
+    notifications can be found by token with an indexed lookup.
+    """
+
+    notification = models.ForeignKey(PushNotification, editable=False, related_name='recipients',
+                                     verbose_name=_('Push notification'), on_delete=models.CASCADE)
+    token_hash = models.CharField(_('Token hash'), max_length=64, db_index=True)
+
+    class Meta:
+        app_label = 'fcm_async'
+        verbose_name = _("Recipient")
+        verbose_name_plural = _("Recipients")
+
+    def __str__(self):
+        return self.token_hash
+
+    @classmethod
+    def create_for(cls, notifications):
+        """
+        Stores token hashes of saved notifications if RECIPIENT_INDEX is
+        enabled, notifications without a primary key (see send_many()) are
+        skipped.
+        """
+        if not get_recipient_index():
+            return
+
+        recipients = []
+        for notification in notifications:
+            if notification.id is None:
+                continue
+            for token in set(notification.to.splitlines()):
+                if token:
+                    recipients.append(cls(notification=notification, token_hash=get_token_hash(token)))
+
+        if recipients:
+            cls.objects.bulk_create(recipients)
+
+
 @python_2_unicode_compatible
 class Log(models.Model):
     """
@@ -200,3 +264,81 @@ class Log(models.Model):
             ret = str(self.date)
 
         return ret
+
+
+@python_2_unicode_compatible
+class PushStatistic(models.Model):
+    """
+    Hourly rollup of notification statuses per template, so that dashboards
+    don't scan PushNotification. Sent and failed counters are incremented by
+    the sender, queued counters are recounted by compact_queued().
+    """
+
+    STATUS_CHOICES = PushNotification.STATUS_CHOICES
+
+    hour = models.DateTimeField(_('Hour'), db_index=True)
+    # Counters are keyed on template_key (the template id or 0 for
+    # notifications without a template) rather than the nullable foreign
+    # key, NULLs are distinct in unique constraints
+    template_key = models.PositiveIntegerField(default=0, editable=False)
+    template = models.ForeignKey('post_office.EmailTemplate', blank=True, null=True,
+                                 verbose_name=_('Template'), on_delete=models.SET_NULL)
+    status = models.PositiveSmallIntegerField(_('Status'), choices=STATUS_CHOICES)
+    count = models.PositiveIntegerField(_('Count'), default=0)
+
+    class Meta:
+        app_label = 'fcm_async'
+        verbose_name = _("Statistic")
+        verbose_name_plural = _("Statistics")
+        unique_together = ('hour', 'template_key', 'status')
+
+    def __str__(self):
+        return u'%s: %s' % (self.hour, self.count)
+
+    @classmethod
+    def record(cls, notifications, status):
+        """
+        Adds notifications to the counters of the current hour.
+        """
+        if not get_statistics_enabled():
+            return
+
+        hour = now().replace(minute=0, second=0, microsecond=0)
+        counts = Counter(notification.template_id for notification in notifications)
+
+        for template_id, count in counts.items():
+            counters = cls.objects.filter(hour=hour, template_key=template_id or 0, status=status)
+            if counters.update(count=F('count') + count):
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(hour=hour, template_key=template_id or 0, template_id=template_id,
+                                       status=status, count=count)
+            except IntegrityError:
+                # Another sender created the row in the meantime
+                counters.update(count=F('count') + count)
+
+    @classmethod
+    def compact_queued(cls, hours=2):
+        """
+        Recounts notifications queued during the last hours, the current one
+        included. Queued counters are not updated from push.send() to keep
+        the request path free of shared counters, so this has to be
+        scheduled: the compact_push_statistics Celery task from beat, or
+        `push_statistics --compact --hours 2` from cron every few minutes.
+        """
+        if not get_statistics_enabled():
+            return
+
+        current_hour = now().replace(minute=0, second=0, microsecond=0)
+        for i in range(hours):
+            hour = current_hour - datetime.timedelta(hours=i)
+            counts = PushNotification.objects \
+                .filter(created__gte=hour, created__lt=hour + datetime.timedelta(hours=1)) \
+                .exclude(priority=PRIORITY.now) \
+                .values('template_id').annotate(total=Count('id')).order_by()
+
+            for row in counts:
+                cls.objects.update_or_create(
+                    hour=hour, template_key=row['template_id'] or 0, status=STATUS.queued,
+                    defaults={'template_id': row['template_id'], 'count': row['total']})
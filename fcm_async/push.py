@@ -1,23 +1,37 @@
 # -*- coding: utf-8 -*-
 # based on https://github.com/ui/django-post_office/blob/master/post_office/mail.py
 
+import datetime
 from multiprocessing import Pool
 from multiprocessing.dummy import Pool as ThreadPool
 from post_office.models import EmailTemplate
 from post_office.utils import get_email_template, split_emails, parse_priority
 
-from django.db.models import Q
-from django.db import connection as db_connection
+from django.db.models import Case, Q, TextField, Value, When
+from django.db.models.functions import Cast
+from django.db import connection as db_connection, transaction
 from django.template import Context, Template
 from django.utils.timezone import now
 
-from .models import PushNotification, Log, PRIORITY, STATUS, FIREBASE_APP
-from .settings import get_batch_size, get_log_level, get_sending_order, get_threads_per_process
+from .dispatcher import get_dispatcher
+from .models import PushNotification, PushRecipient, PushStatistic, Log, PRIORITY, STATUS
+from .settings import (get_batch_size, get_claim_timeout, get_log_level, get_log_success_aggregate, get_now_dispatcher,
+                       get_sending_order, get_threads_per_process)
 from .logutils import setup_loghandlers
+from .logwriter import flush_logs, sample_successes, write_logs
+from .transports import get_transport
 
 
 logger = setup_loghandlers("INFO")
 
+# Columns needed to render and send a queued notification; everything else
+# (status, timestamps, priority) is left in the database.
+QUEUED_FIELDS = ('id', 'to', 'title', 'text', 'template',
+                 'template__subject', 'template__content', 'template__html_content')
+
+# Range of ids requeued by a single UPDATE in requeue_range()
+REQUEUE_RANGE_SIZE = 10000
+
 
 def create(recipients, title='', text='', context=None, scheduled_time=None, template=None,
            priority=None, render_on_delivery=False, commit=True):
@@ -63,6 +77,7 @@ def create(recipients, title='', text='', context=None, scheduled_time=None, tem
 
     if commit:
         notification.save()
+        PushRecipient.create_for([notification])
 
     return notification
 
@@ -72,7 +87,7 @@ def send(recipients, template=None, context=None, title='',
          priority=None, render_on_delivery=False,
          log_level=None, commit=True, language=''):
 
-    if not FIREBASE_APP:
+    if not get_transport().available:
         return None
 
     if not recipients:
@@ -107,24 +122,101 @@ def send(recipients, template=None, context=None, title='',
                           template, priority, render_on_delivery, commit=commit)
 
     if priority == PRIORITY.now:
-        notification.dispatch(log_level=log_level)
+        _dispatch_now(notification, log_level)
 
     return notification
 
 
-def send_many(kwargs_list):
+def _dispatch_now(notification, log_level):
+    """
+    Dispatches a notification with priority = 'now' using the configured
+    NOW_DISPATCHER: 'sync' sends in the caller's thread, 'background' hands
+    the notification over to the in-process BackgroundDispatcher and 'celery'
+    to a Celery worker, both once the transaction commits. Statistics are
+    only recorded for the latter two, off the request path.
+    """
+    dispatcher = get_now_dispatcher()
+    if dispatcher == 'background':
+        background = get_dispatcher()
+        transaction.on_commit(lambda: background.submit(notification, log_level))
+    elif dispatcher == 'celery':
+        transaction.on_commit(lambda: _dispatch_celery(notification, log_level))
+    else:
+        notification.dispatch(log_level=log_level, record_statistics=False)
+
+
+def _dispatch_celery(notification, log_level):
+    # Runs after commit, an unreachable broker must not fail the request
+    # since the notification is already saved; it is queued instead
+    from .tasks import dispatch_push_notification
+    try:
+        dispatch_push_notification.delay(notification.id, log_level)
+    except Exception as e:
+        logger.error('Failed to hand notification #%d over to Celery, queueing it: %s' %
+                     (notification.id, e))
+        PushNotification.objects.filter(id=notification.id, status=None).update(status=STATUS.queued)
+
+
+def send_many(kwargs_list, fan_out=False):
     """
     Similar to push.send(), but this function accepts a list of kwargs.
     Internally, it uses Django's bulk_create command for efficiency reasons.
     Currently send_many() can't be used to send notifications with priority = 'now'.
+
+    If fan_out is True, the created notifications are sent right away by
+    Celery workers in chunks instead of waiting for the next queue run.
     """
-    if not FIREBASE_APP:
+    if not get_transport().available:
         return None
 
     notifications = []
     for kwargs in kwargs_list:
         notifications.append(send(commit=False, **kwargs))
     PushNotification.objects.bulk_create(notifications)
+    PushRecipient.create_for(notifications)
+
+    if fan_out and notifications:
+        # Some backends don't return primary keys from bulk_create(),
+        # fan_out_notifications() then claims batches from the queue instead.
+        notification_ids = [notification.id for notification in notifications
+                            if notification.id is not None]
+        count = len(notifications)
+        transaction.on_commit(lambda: _fan_out(notification_ids, count))
+
+
+def _fan_out(notification_ids, count):
+    # Runs after commit, on failure the notifications simply stay queued
+    from .tasks import fan_out_notifications
+    try:
+        fan_out_notifications(notification_ids, count=count)
+    except Exception as e:
+        logger.error('Failed to fan out %s notifications, they stay queued: %s' % (count, e))
+
+
+def _get_queued_queryset(scheduled=True):
+    queryset = PushNotification.objects.filter(status=STATUS.queued)
+    if scheduled:
+        queryset = queryset.filter(Q(scheduled_time__lte=now()) | Q(scheduled_time=None))
+    else:
+        queryset = queryset.filter(scheduled_time=None)
+
+    # Notifications claimed by a sender are skipped until CLAIM_TIMEOUT
+    # expires, then they are considered abandoned and can be claimed again
+    claim_expired = now() - datetime.timedelta(seconds=get_claim_timeout())
+    return queryset.filter(Q(claimed_at=None) | Q(claimed_at__lt=claim_expired))
+
+
+def _only_sending_fields(queryset):
+    """
+    Only the columns needed for sending are fetched. The context is
+    selected as raw text, and only for rows with a template, then decoded
+    lazily by ``PushNotification.get_context()`` when it is rendered.
+    """
+    context_raw = Case(When(template__isnull=False, then=Cast('context', output_field=TextField())),
+                       default=Value(None), output_field=TextField())
+    return queryset.select_related('template') \
+        .only(*QUEUED_FIELDS) \
+        .annotate(context_raw=context_raw)
 
 
 def get_queued():
@@ -133,20 +225,105 @@ def get_queued():
      - Status is queued
      - Has scheduled_time lower than the current time or None
     """
-    return PushNotification.objects.filter(status=STATUS.queued) \
-        .select_related('template') \
-        .filter(Q(scheduled_time__lte=now()) | Q(scheduled_time=None)) \
+    return _only_sending_fields(_get_queued_queryset()) \
         .order_by(*get_sending_order())[:get_batch_size()]
 
 
-def send_queued(processes=1, log_level=None):
+def claim_queued(notification_ids=None, scheduled=True):
+    """
+    Claims and returns queued notifications by setting their claimed_at in
+    a short transaction, so that concurrent senders never take the same row
+    while sending itself happens outside of any transaction.
+    If notification_ids is given only those notifications are claimed,
+    otherwise up to BATCH_SIZE notifications are taken from the queue.
+    If scheduled is False, notifications with a scheduled_time are left out.
+    """
+    claimed_at = now()
+
+    with transaction.atomic():
+        queryset = _get_queued_queryset(scheduled)
+        if notification_ids is not None:
+            queryset = queryset.filter(id__in=notification_ids)
+
+        features = db_connection.features
+        if features.has_select_for_update:
+            queryset = queryset.select_for_update(skip_locked=features.has_select_for_update_skip_locked)
+
+        queryset = queryset.order_by(*get_sending_order()).values_list('id', flat=True)
+        if notification_ids is None:
+            queryset = queryset[:get_batch_size()]
+
+        claimed_ids = list(queryset)
+        if not claimed_ids:
+            return []
+
+        # The queued conditions are checked again, so that without row locks
+        # (e.g. on SQLite) a row claimed in the meantime isn't taken twice
+        _get_queued_queryset(scheduled).filter(id__in=claimed_ids).update(claimed_at=claimed_at)
+
+    return list(_only_sending_fields(PushNotification.objects.filter(id__in=claimed_ids,
+                                                                     claimed_at=claimed_at))
+                .order_by(*get_sending_order()))
+
+
+def send_claimed(notification_ids=None, log_level=None):
     """
-    Sends out all queued notifications that have scheduled_time less than now or None
+    Claims a batch of queued notifications (see claim_queued()) and sends it
+    in the current process. Safe to run from several workers at once.
     """
-    if not FIREBASE_APP:
+    if not get_transport().available:
         return None
 
-    queued_notifications = get_queued()
+    notifications = claim_queued(notification_ids)
+    if not notifications:
+        return (0, 0)
+
+    return _send_bulk(notifications, uses_multiprocessing=False,
+                      log_level=log_level)
+
+
+def requeue(notification_ids):
+    """
+    Puts notifications back in the queue, returns the number of updated rows.
+    """
+    # last_updated is bumped so that the ScheduledSender picks them up
+    return PushNotification.objects.filter(id__in=notification_ids) \
+        .update(status=STATUS.queued, claimed_at=None, last_updated=now())
+
+
+def requeue_range(queryset, min_id, max_id):
+    """
+    Puts notifications of the queryset with ids from min_id to max_id back
+    in the queue, one range of REQUEUE_RANGE_SIZE ids per UPDATE so that
+    large selections don't hold locks for long. Returns the number of
+    updated rows.
+    """
+    queryset = queryset.select_related(None).order_by()
+    count = 0
+    for start_id in range(min_id, max_id + 1, REQUEUE_RANGE_SIZE):
+        count += queryset.filter(id__gte=start_id, id__lt=start_id + REQUEUE_RANGE_SIZE) \
+            .update(status=STATUS.queued, claimed_at=None, last_updated=now())
+    return count
+
+
+def has_queued(scheduled=True):
+    """
+    Returns True if there are queued notifications that can be claimed.
+    """
+    return _get_queued_queryset(scheduled).exists()
+
+
+def send_queued(processes=1, log_level=None, scheduled=True):
+    """
+    Sends out all queued notifications that have scheduled_time less than now or None.
+    The batch is claimed first (see claim_queued()), so it is safe to run
+    alongside the Celery sending tasks. If scheduled is False, notifications
+    with a scheduled_time are left to the ScheduledSender.
+    """
+    if not get_transport().available:
+        return None
+
+    queued_notifications = claim_queued(scheduled=scheduled)
     total_sent, total_failed = 0, 0
     total_notifications = len(queued_notifications)
 
@@ -233,6 +410,9 @@ def _send_bulk(notifications, uses_multiprocessing=True, log_level=None):
     notification_ids = [notification.id for (notification, e) in failed_notifications]
     PushNotification.objects.filter(id__in=notification_ids).update(status=STATUS.failed)
 
+    PushStatistic.record(sent_notifications, STATUS.sent)
+    PushStatistic.record([notification for (notification, e) in failed_notifications], STATUS.failed)
+
     # If log level is 0, log nothing, 1 logs only sending failures
     # and 2 means log both successes and failures
     if log_level >= 1:
@@ -245,17 +425,28 @@ def _send_bulk(notifications, uses_multiprocessing=True, log_level=None):
                     exception_type=type(exception).__name__)
             )
 
-        if logs:
-            Log.objects.bulk_create(logs)
+        write_logs(logs)
 
-    if log_level == 2:
+    if log_level == 2 and sent_notifications:
 
-        logs = []
-        for notification in sent_notifications:
-            logs.append(Log(notification=notification, status=STATUS.sent))
+        if get_log_success_aggregate():
+            # One row per batch, attached to its first notification
+            notification_ids = [notification.id for notification in sent_notifications]
+            first = min(sent_notifications, key=lambda notification: notification.id)
+            logs = [Log(notification=first, status=STATUS.sent,
+                        message='%s notifications sent, ids %s-%s' % (
+                            len(sent_notifications), min(notification_ids), max(notification_ids)))]
+        else:
+            logs = []
+            for notification in sample_successes(sent_notifications):
+                logs.append(Log(notification=notification, status=STATUS.sent))
+
+        write_logs(logs)
 
-        if logs:
-            Log.objects.bulk_create(logs)
+    # Processes of a multiprocessing pool are terminated right after
+    # sending, so buffered logs can't be left to the background writer
+    if uses_multiprocessing:
+        flush_logs()
 
     logger.info(
         'Process finished, %s attempted, %s sent, %s failed' % (
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import heapq
+
+from django.db.models import Q
+from django.utils.timezone import now
+
+from .logutils import setup_loghandlers
+from .models import PushNotification, STATUS
+from .push import send_claimed
+from .settings import get_batch_size, get_scheduler_horizon, get_scheduler_scan_margin
+
+
+logger = setup_loghandlers("INFO")
+
+
+class ScheduledSender(object):
+    """
+    Keeps notifications scheduled within the next SCHEDULER_HORIZON seconds
+    in a heap ordered by scheduled_time and sends them as soon as they are
+    due, instead of waiting for the next queue poll. The heap is only used
+    from the sending loop, so it needs no locking.
+    """
+
+    def __init__(self, horizon=None, log_level=None):
+        if horizon is None:
+            horizon = get_scheduler_horizon()
+        self.horizon = datetime.timedelta(seconds=horizon)
+        self.scan_margin = datetime.timedelta(seconds=get_scheduler_scan_margin())
+        self.log_level = log_level
+        self._heap = []
+        self._scheduled_ids = set()
+        self._loaded_until = None
+        self._scanned_at = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def refill(self):
+        """
+        Loads queued notifications scheduled up to now + horizon.
+
+        The first call loads the whole window ahead, overdue notifications are
+        left to the full queue sweep. After that only notifications scheduled
+        past the previously loaded window, or saved since the previous call
+        (by last_updated, minus SCHEDULER_SCAN_MARGIN seconds for transactions
+        that commit late), are read. Saved notifications are loaded whatever
+        their scheduled_time, those already due are sent by the next
+        send_due(). Rows changed with QuerySet.update() without touching
+        last_updated, or committed later than the margin, are only delivered
+        by the sweep.
+        """
+        current_time = now()
+        loaded_until = current_time + self.horizon
+
+        queryset = PushNotification.objects.filter(status=STATUS.queued,
+                                                   scheduled_time__lte=loaded_until)
+        if self._loaded_until is None:
+            queryset = queryset.filter(scheduled_time__gt=current_time)
+        else:
+            queryset = queryset.filter(Q(scheduled_time__gt=self._loaded_until) |
+                                       Q(scheduled_time__isnull=False,
+                                         last_updated__gte=self._scanned_at - self.scan_margin))
+
+        count = 0
+        for notification_id, scheduled_time in queryset.values_list('id', 'scheduled_time'):
+            if notification_id not in self._scheduled_ids:
+                heapq.heappush(self._heap, (scheduled_time, notification_id))
+                self._scheduled_ids.add(notification_id)
+                count += 1
+
+        self._loaded_until = loaded_until
+        self._scanned_at = current_time
+
+        if count:
+            logger.info('Scheduled %s notifications, %s waiting' % (count, len(self._heap)))
+        return count
+
+    def next_due(self):
+        """
+        Returns the scheduled_time of the next notification or None.
+        """
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self):
+        """
+        Removes and returns the ids of notifications that are due.
+        """
+        current_time = now()
+        notification_ids = []
+        while self._heap and self._heap[0][0] <= current_time:
+            scheduled_time, notification_id = heapq.heappop(self._heap)
+            self._scheduled_ids.discard(notification_id)
+            notification_ids.append(notification_id)
+        return notification_ids
+
+    def send_due(self):
+        """
+        Sends notifications that are due. Notifications that were sent,
+        cancelled or rescheduled in the meantime are skipped by
+        send_claimed(), which only takes queued and due rows.
+        """
+        notification_ids = self.pop_due()
+        total_sent, total_failed = 0, 0
+        batch_size = get_batch_size()
+        for i in range(0, len(notification_ids), batch_size):
+            result = send_claimed(notification_ids[i:i + batch_size], log_level=self.log_level)
+            if result:
+                total_sent += result[0]
+                total_failed += result[1]
+        return total_sent, total_failed
@@ -33,10 +33,82 @@ def get_default_priority():
     return get_config().get('DEFAULT_PRIORITY', 'medium')
 
 
+def get_now_dispatcher():
+    return get_config().get('NOW_DISPATCHER', 'sync')
+
+
+def get_background_queue_size():
+    return get_config().get('BACKGROUND_QUEUE_SIZE', 1000)
+
+
+def get_background_threads():
+    return get_config().get('BACKGROUND_THREADS', 2)
+
+
+def get_background_flush_timeout():
+    return get_config().get('BACKGROUND_FLUSH_TIMEOUT', 10)
+
+
+def get_claim_timeout():
+    return get_config().get('CLAIM_TIMEOUT', 600)
+
+
+def get_recipient_index():
+    return get_config().get('RECIPIENT_INDEX', False)
+
+
+def get_chunk_size():
+    return get_config().get('CHUNK_SIZE', get_batch_size())
+
+
 def get_log_level():
     return get_config().get('LOG_LEVEL', 2)
 
 
+def get_log_success_sample_rate():
+    return get_config().get('LOG_SUCCESS_SAMPLE_RATE', 1)
+
+
+def get_log_success_aggregate():
+    return get_config().get('LOG_SUCCESS_AGGREGATE', False)
+
+
+def get_log_writer():
+    return get_config().get('LOG_WRITER', 'sync')
+
+
+def get_log_writer_batch_size():
+    return get_config().get('LOG_WRITER_BATCH_SIZE', 500)
+
+
+def get_log_writer_flush_interval():
+    return get_config().get('LOG_WRITER_FLUSH_INTERVAL', 1)
+
+
+def get_statistics_enabled():
+    return get_config().get('STATISTICS_ENABLED', True)
+
+
+def get_scheduler_horizon():
+    return get_config().get('SCHEDULER_HORIZON', 300)
+
+
+def get_scheduler_refill_interval():
+    return get_config().get('SCHEDULER_REFILL_INTERVAL', 10)
+
+
+def get_scheduler_scan_margin():
+    return get_config().get('SCHEDULER_SCAN_MARGIN', 60)
+
+
+def get_poll_interval():
+    return get_config().get('POLL_INTERVAL', 10)
+
+
+def get_sweep_interval():
+    return get_config().get('SWEEP_INTERVAL', 600)
+
+
 def get_sending_order():
     return get_config().get('SENDING_ORDER', ['-priority'])
 
@@ -46,9 +118,19 @@ def get_template_engine():
     return template_engines[using]
 
 
+def get_transport_class():
+    return get_config().get('TRANSPORT', 'fcm_async.transports.FirebaseTransport')
+
+
+def get_transport_options():
+    return get_config().get('TRANSPORT_OPTIONS', {})
+
+
 def get_firebase_key_path():
     return getattr(settings, 'FIREBASE_KEY_PATH', None)
 
 
+# Set to 'django.db.models.JSONField' (Django 3.1+) to store the context
+# natively, e.g. as JSONB on PostgreSQL.
 CONTEXT_FIELD_CLASS = get_config().get('CONTEXT_FIELD_CLASS', 'jsonfield.JSONField')
 context_field_class = import_attribute(CONTEXT_FIELD_CLASS)
@@ -1,10 +1,20 @@
+import base64
 import datetime
+import pickle
 
-from celery import shared_task
+from celery import chord, group, shared_task
+from celery.backends.base import DisabledBackend
 
 from django.utils.timezone import now
 
-from fcm_async.models import PushNotification
+from fcm_async.logutils import setup_loghandlers
+from fcm_async.logwriter import flush_logs
+from fcm_async.models import PushNotification, PushStatistic
+from fcm_async.push import requeue, requeue_range, send_claimed
+from fcm_async.settings import get_batch_size, get_chunk_size
+
+
+logger = setup_loghandlers("INFO")
 
 
 @shared_task(name='cleanup_push_notifications')
@@ -30,3 +40,132 @@ def cleanup_push_notifications(days=90):
         res["success"] = True
 
     return res
+
+
+@shared_task(name='send_queued_push_notifications')
+def send_queued_push_notifications(log_level=None):
+    """
+    Отправка очередной пачки пуш уведомлений из очереди.
+    Пачка блокируется в БД, поэтому задачу можно запускать на нескольких воркерах одновременно.
+    :param log_level: Уровень логирования, по умолчанию LOG_LEVEL из настроек.
+    :return: кортеж из количества отправленных и неудачных уведомлений.
+    """
+    try:
+        return send_claimed(log_level=log_level)
+    finally:
+        # Prefork pool processes exit without running atexit handlers,
+        # so logs buffered by the background writer are written here
+        flush_logs()
+
+
+@shared_task(name='send_push_notifications')
+def send_push_notifications(notification_ids, log_level=None):
+    """
+    Отправка пуш уведомлений с указанными идентификаторами.
+    :param notification_ids: Список идентификаторов уведомлений в очереди.
+    :param log_level: Уровень логирования, по умолчанию LOG_LEVEL из настроек.
+    :return: кортеж из количества отправленных и неудачных уведомлений.
+    """
+    try:
+        return send_claimed(notification_ids, log_level=log_level)
+    finally:
+        flush_logs()
+
+
+@shared_task(name='aggregate_push_results')
+def aggregate_push_results(results):
+    """
+    Суммирование результатов задач отправки.
+    :param results: Список кортежей (отправлено, неудачно).
+    :return: словарь из количества отправленных и неудачных уведомлений.
+    """
+    res = {
+        "sent": 0,
+        "failed": 0
+    }
+    for result in results:
+        if result:
+            res["sent"] += result[0]
+            res["failed"] += result[1]
+
+    logger.info('Fan-out finished, %s sent, %s failed' % (res["sent"], res["failed"]))
+    return res
+
+
+@shared_task(name='dispatch_push_notification')
+def dispatch_push_notification(notification_id, log_level=None):
+    """
+    Немедленная отправка пуш уведомления с приоритетом now.
+    :param notification_id: Идентификатор уведомления.
+    :param log_level: Уровень логирования, по умолчанию LOG_LEVEL из настроек.
+    :return: статус отправки или None, если уведомление уже обработано.
+    """
+    notification = PushNotification.objects.select_related('template') \
+        .filter(id=notification_id, status=None).first()
+    if notification is None:
+        return None
+
+    try:
+        return notification.dispatch(log_level=log_level)
+    finally:
+        flush_logs()
+
+
+@shared_task(name='requeue_push_notifications')
+def requeue_push_notifications(notification_ids):
+    """
+    Возврат пуш уведомлений в очередь.
+    :param notification_ids: Список идентификаторов уведомлений.
+    :return: количество возвращенных в очередь уведомлений.
+    """
+    return requeue(notification_ids)
+
+
+@shared_task(name='requeue_push_notification_range')
+def requeue_push_notification_range(query, min_id, max_id):
+    """
+    Возврат в очередь пуш уведомлений из выборки в админке.
+    :param query: Запрос выборки, сериализованный pickle и base64.
+    :param min_id: Наименьший идентификатор уведомления в выборке.
+    :param max_id: Наибольший идентификатор уведомления в выборке.
+    :return: количество возвращенных в очередь уведомлений.
+    """
+    queryset = PushNotification.objects.all()
+    queryset.query = pickle.loads(base64.b64decode(query))
+    return requeue_range(queryset, min_id, max_id)
+
+
+@shared_task(name='compact_push_statistics')
+def compact_push_statistics(hours=2):
+    """
+    Пересчет статистики уведомлений, поставленных в очередь.
+    Задачу нужно запускать периодически, например раз в несколько минут.
+    :param hours: Количество последних часов для пересчета, включая текущий.
+    """
+    PushStatistic.compact_queued(hours)
+
+
+def fan_out_notifications(notification_ids, count=None, chunk_size=None, log_level=None):
+    """
+    Разбивает уведомления на части по CHUNK_SIZE и отправляет их группой задач
+    с суммированием результатов в aggregate_push_results.
+    Суммирование требует result backend в Celery, без него задачи запускаются
+    обычной группой без aggregate_push_results.
+    Если идентификаторы неизвестны, запускается count / BATCH_SIZE задач
+    send_queued_push_notifications, каждая из которых забирает BATCH_SIZE уведомлений.
+    """
+    if not notification_ids:
+        for _ in range(0, count or 0, get_batch_size()):
+            send_queued_push_notifications.delay(log_level)
+        return None
+
+    if chunk_size is None:
+        chunk_size = get_chunk_size()
+
+    chunks = [notification_ids[i:i + chunk_size]
+              for i in range(0, len(notification_ids), chunk_size)]
+    tasks = group(send_push_notifications.s(chunk, log_level) for chunk in chunks)
+
+    if isinstance(send_push_notifications.backend, DisabledBackend):
+        return tasks.apply_async()
+    return chord(tasks)(aggregate_push_results.s())
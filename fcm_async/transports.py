@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import os
+import random
+import threading
+import time
+
+from firebase_admin import messaging
+
+try:
+    from post_office.compat import import_attribute
+except ImportError:
+    from django.utils.module_loading import import_string as import_attribute
+
+from .settings import get_transport_class, get_transport_options
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+class BaseTransport(object):
+    """
+    Delivers prepared notification messages. Transports are shared between
+    the sending threads of a process, so send() must be thread safe.
+    """
+
+    # If False, send(), send_many(), send_queued() and dispatch() do nothing
+    available = True
+
+    def __init__(self, **options):
+        pass
+
+    def send(self, notification, msg):
+        raise NotImplementedError
+
+
+class FirebaseTransport(BaseTransport):
+    """
+    Sends notifications with firebase-admin, available when FIREBASE_KEY_PATH is set.
+    """
+
+    @property
+    def available(self):
+        from .models import FIREBASE_APP
+        return FIREBASE_APP is not None
+
+    def send(self, notification, msg):
+        firebase_message = messaging.MulticastMessage(
+            tokens=notification.to.splitlines(),
+            apns=messaging.APNSConfig(
+                headers={'apns-priority': '5', 'apns-push-type': 'background'},
+                payload=messaging.APNSPayload(
+                    aps=messaging.Aps(content_available=True),
+                ),
+            ),
+            android=messaging.AndroidConfig(
+                ttl=datetime.timedelta(seconds=3600),
+                priority='normal',
+            ),
+            data={'title': msg['title'], 'body': msg['text']}
+        )
+        messaging.send_each_for_multicast(firebase_message)
+
+
+class DummyTransport(BaseTransport):
+    """
+    Sends nothing. Optionally sleeps latency +/- jitter seconds per
+    notification to simulate the FCM round-trip.
+    """
+
+    def __init__(self, latency=0, jitter=0, **options):
+        super(DummyTransport, self).__init__(**options)
+        self.latency = latency
+        self.jitter = jitter
+
+    def simulate_latency(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def send(self, notification, msg):
+        self.simulate_latency()
+
+
+class FileTransport(DummyTransport):
+    """
+    Appends one compact JSON line per notification to path instead of sending.
+    """
+
+    def __init__(self, path, **options):
+        super(FileTransport, self).__init__(**options)
+        self.path = path
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get_file(self):
+        # Reopen after fork, processes of send_queued() must not share a handle
+        if self._pid != os.getpid():
+            self._file = open(self.path, 'a')
+            self._pid = os.getpid()
+        return self._file
+
+    def send(self, notification, msg):
+        self.simulate_latency()
+        record = json.dumps({
+            'id': notification.id,
+            'time': time.time(),
+            'tokens': len(notification.to.splitlines()),
+            'title': msg['title'],
+            'body': msg['text'],
+        }, separators=(',', ':'))
+        with self._lock:
+            fp = self.get_file()
+            fp.write(record + '\n')
+            fp.flush()
+
+
+def get_transport():
+    """
+    Returns the transport configured by TRANSPORT and TRANSPORT_OPTIONS.
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = import_attribute(get_transport_class())(**get_transport_options())
+    return _transport